@@ -1,13 +1,129 @@
+import datetime
+import functools
+
 import flask
 import functions_framework
 from google.cloud import bigquery
 
 
+# Create the BigQuery client once per instance, so that warm instances reuse
+# the same connection instead of opening a new one on every request.
+client = bigquery.Client(project='indego-bikeshare-tools')
+
+
+# The hourly trip counts are precomputed in materialized views (see
+# sql/create_core_station_*_hour_counts.sql), so the query only needs to add
+# up the hours in the requested range for each station and day in the
+# requested date range, and then average over the days. Origins and
+# destinations are stacked and counted in a single aggregation, rather than
+# aggregated separately and joined.
+#
+# The result is a single row with the whole response already serialized as
+# a JSON array, so there's nothing left to do with it in Python.
+POPULARITY_SQL = '''
+WITH hourly_trip_count AS (
+    SELECT
+        station_id,
+        trip_date,
+        station_pt,
+        trip_count AS origin_count,
+        0 AS destination_count
+    FROM `indego-bikeshare-tools.core.station_origin_hour_counts`
+    WHERE hour BETWEEN @start_hour AND @end_hour
+        AND trip_date BETWEEN @from_date AND @to_date
+
+    UNION ALL
+
+    SELECT
+        station_id,
+        trip_date,
+        station_pt,
+        0 AS origin_count,
+        trip_count AS destination_count
+    FROM `indego-bikeshare-tools.core.station_destination_hour_counts`
+    WHERE hour BETWEEN @start_hour AND @end_hour
+        AND trip_date BETWEEN @from_date AND @to_date
+),
+
+daily_trip_count AS (
+    SELECT
+        station_id,
+        trip_date,
+        ANY_VALUE(station_pt) AS station_pt,
+        SUM(origin_count) AS origin_count,
+        SUM(destination_count) AS destination_count
+    FROM hourly_trip_count
+    GROUP BY station_id, trip_date
+),
+
+average_trip_count AS (
+    SELECT
+        station_id,
+        ANY_VALUE(station_pt) AS station_pt,
+        AVG(origin_count) AS P_o,
+        AVG(destination_count) AS P_d
+    FROM daily_trip_count
+    GROUP BY station_id
+)
+
+SELECT
+    TO_JSON_STRING(ARRAY(
+        SELECT AS STRUCT
+            station_id,
+            st_asgeojson(station_pt) as geometry,
+            P_o,
+            P_d,
+            P_o + P_d AS P
+        FROM average_trip_count
+    )) AS payload
+'''
+
+
+@functools.lru_cache(maxsize=512)
+def _popularity(
+        start_hour: int,
+        end_hour: int,
+        from_date: datetime.date,
+        to_date: datetime.date) -> str:
+    """
+    Query the average station popularity between start_hour and end_hour, on
+    days from from_date to to_date, and return it serialized as a JSON
+    string.
+
+    There are only a few hundred valid (start_hour, end_hour) pairs, most
+    requests use the default date range, and the trip data changes at most
+    once a quarter, so the results are cached for the life of the instance.
+    """
+    # Pass the hours and dates as query parameters instead of formatting them
+    # into the SQL. The query text is then identical for every request, so
+    # BigQuery can answer repeated requests from its result cache.
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter('start_hour', 'INT64', start_hour),
+            bigquery.ScalarQueryParameter('end_hour', 'INT64', end_hour),
+            bigquery.ScalarQueryParameter('from_date', 'DATE', from_date),
+            bigquery.ScalarQueryParameter('to_date', 'DATE', to_date),
+        ],
+        use_query_cache=True,
+    )
+
+    # Run the SQL against BigQuery. The one row that comes back holds the
+    # JSON that I return to the client: a list of objects, one per station.
+    rows = client.query_and_wait(POPULARITY_SQL, job_config=job_config)
+    return next(iter(rows)).payload
+
+
 @functions_framework.http
 def get_popularity(request: flask.Request) -> flask.typing.ResponseReturnValue:
     start_hour = request.args.get('start_hour') or 0
     end_hour = request.args.get('end_hour') or 23
 
+    # By default, only look at the last year of trips. Restricting the dates
+    # also limits how much of the trip counts BigQuery has to scan.
+    today = datetime.date.today()
+    from_date = request.args.get('from_date') or (today - datetime.timedelta(days=365)).isoformat()
+    to_date = request.args.get('to_date') or today.isoformat()
+
     # Validate the input
     try:
         start_hour = int(start_hour)
@@ -21,79 +137,32 @@ def get_popularity(request: flask.Request) -> flask.typing.ResponseReturnValue:
     except ValueError as e:
         return flask.jsonify({'error': str(e)}), 400
 
-    sql = f'''
-    WITH daily_origin_trip_count AS (
-        SELECT
-            start_station as station_id,
-            start_date as trip_date,
-            any_value(start_pt) as station_pt,
-            count(*) AS trip_count
-        FROM `indego-bikeshare-tools.core.indego_trips`
-        WHERE EXTRACT(HOUR FROM start_time) BETWEEN {start_hour} AND {end_hour}
-        GROUP BY start_station, start_date
-    ),
-
-    daily_destination_trip_count AS (
-        SELECT
-            end_station as station_id,
-            end_date as trip_date,
-            any_value(end_pt) as station_pt,
-            count(*) AS trip_count
-        FROM `indego-bikeshare-tools.core.indego_trips`
-        WHERE EXTRACT(HOUR FROM end_time) BETWEEN {start_hour} AND {end_hour}
-        GROUP BY end_station, end_date
-    ),
-
-    average_trip_count AS (
-        SELECT
-            station_id,
-            ANY_VALUE(o.station_pt) AS station_pt,
-            AVG(o.trip_count) AS P_o,
-            AVG(d.trip_count) AS P_d
-        FROM daily_origin_trip_count AS o
-        JOIN daily_destination_trip_count AS d USING (station_id, trip_date)
-        GROUP BY station_id
-    )
+    try:
+        from_date = datetime.date.fromisoformat(from_date)
+        to_date = datetime.date.fromisoformat(to_date)
+    except ValueError:
+        return flask.jsonify({'error': "from_date and to_date must be dates in YYYY-MM-DD format"}), 400
+    if from_date > to_date:
+        return flask.jsonify({'error': "from_date must not be after to_date"}), 400
 
-    SELECT
-        station_id,
-        st_asgeojson(station_pt) as geometry,
-        P_o,
-        P_d,
-        P_o + P_d AS P
-    FROM average_trip_count
-    '''
-
-    # Run the SQL against BigQuery
-    client = bigquery.Client(project='indego-bikeshare-tools')
-    rows = client.query_and_wait(sql)
-
-    # Convert the rows to a list of dictionaries. This will be the data
-    # that I return to the client.
-    data = [
-        {
-            'station_id': row.station_id,
-            'geometry': row.geometry,
-            'P_o': row.P_o,
-            'P_d': row.P_d,
-            'P': row.P,
-        }
-        for row in rows
-    ]
+    data = _popularity(start_hour, end_hour, from_date, to_date)
 
     # The usual HTTP status code for a successful request with data is 200.
     status_code = 200
 
     # Set CORS headers to allow cross-origin requests. This is necessary
     # because the API is hosted on a different domain than the front-end.
+    # The data only changes when new trips are loaded, so browsers and CDNs
+    # can also cache the response for a while.
     headers = {
         'Access-Control-Allow-Origin': '*',
         'Access-Control-Allow-Methods': '*',
         'Access-Control-Allow-Headers': 'Content-Type',
+        'Cache-Control': 'public, max-age=3600',
+        'Content-Type': 'application/json',
     }
 
-    # Finally, I return a tuple of the data, status code, and headers.
-    # Flask will take care of converting the data to JSON and setting the
-    # Content-Type header to application/json, as long as I give it a list
-    # or a dictionary.
+    # Finally, I return a tuple of the data, status code, and headers. The
+    # data is already a JSON string, so I set the Content-Type header myself
+    # instead of letting Flask do it.
     return data, status_code, headers
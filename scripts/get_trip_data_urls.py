@@ -5,7 +5,11 @@ https://www.rideindego.com/about/data/
 Usage:
     python get_trip_data_urls.py
 """
+import json
+import os
+import pathlib
 import requests
+import time
 from bs4 import BeautifulSoup
 import sys
 
@@ -13,8 +17,40 @@ import sys
 DataFileName = str
 DataFileUrl = str
 
+# The list of files only changes when a new quarter is published, so keep
+# scraped results around for a day.
+CACHE_PATH = pathlib.Path(__file__).parent.parent / "data" / ".cache" / "trip_urls.json"
+CACHE_TTL_SECONDS = 24 * 60 * 60
+
 
 def get_trip_data_urls() -> list[tuple[DataFileName, DataFileUrl]]:
+    """
+    Get trip data URLs from the Indego bikeshare data portal, using the
+    cached results if they're less than a day old.
+    """
+    if CACHE_PATH.exists() and CACHE_PATH.stat().st_mtime > time.time() - CACHE_TTL_SECONDS:
+        with CACHE_PATH.open() as cachefile:
+            return [tuple(link) for link in json.load(cachefile)]
+
+    trip_data_links = scrape_trip_data_urls()
+
+    # Don't hold on to an empty list for a day; most likely the page layout
+    # changed or the scrape went wrong somehow.
+    if not trip_data_links:
+        return trip_data_links
+
+    # Write to a temporary file first, so that a concurrent run never reads
+    # a partially written cache.
+    CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = CACHE_PATH.with_suffix(f".{os.getpid()}.tmp")
+    with tmp_path.open("w") as cachefile:
+        json.dump(trip_data_links, cachefile)
+    os.replace(tmp_path, CACHE_PATH)
+
+    return trip_data_links
+
+
+def scrape_trip_data_urls() -> list[tuple[DataFileName, DataFileUrl]]:
     """
     Scrape trip data URLs from the Indego bikeshare data portal.
     """
@@ -28,7 +64,7 @@ def get_trip_data_urls() -> list[tuple[DataFileName, DataFileUrl]]:
         f"Failed to fetch data from {url}: {response.status_code}"
 
     # Parse the HTML content using BeautifulSoup
-    soup = BeautifulSoup(response.text, "html.parser")
+    soup = BeautifulSoup(response.text, "lxml")
 
     # Find an `h1` on the page with the text "Trip Data"
     h1 = soup.find("h1", string="Trip Data")
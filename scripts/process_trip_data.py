@@ -1,96 +1,151 @@
 import csv
-import datetime
+import functools
 import io
-import json
+import multiprocessing
+import os
 import pathlib
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import re
 import requests
 import sys
+import threading
 import zipfile
 import typing
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from google.cloud import storage
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from get_trip_data_urls import get_trip_data_urls
 
 DATA_DIR = pathlib.Path(__file__).parent.parent / "data"
-ISO8601_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}(T| )\d{2}:\d{2}:\d{2}(\.\d+)?Z?$")
-
-
-def mdyhm_to_iso(date_str: str) -> str:
-    """
-    Convert a date string from 'M/D/YYYY H:MM' format to ISO 8601 format.
-    """
-    if not date_str:
-        return date_str
 
+# Share one session across downloads (and download threads), so that
+# connections to the data portal get reused. Keep enough connections in the
+# pool for every download thread, and retry transient failures.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+# How much of a download to hold in memory at a time.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Parquet writers issue lots of small writes, so give them bigger buffers
+# than the defaults: 1 MiB for local files, and 8 MiB chunks for GCS uploads
+# (which must be a multiple of 256 KiB).
+LOCAL_WRITE_BUFFER_SIZE = 1024 * 1024
+GCS_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# How much of a trips CSV to read, convert, and write at a time. 16 MiB is
+# on the order of 100,000 trips.
+CSV_BLOCK_SIZE = 16 * 1024 * 1024
+CSV_READ_BUFFER_SIZE = 1024 * 1024
+
+LABEL_PATTERN = re.compile(r"^(\d{4}) Q(\d) .*$")
+RAW_FILE_NAME_PATTERN = re.compile(r"^indego-trips-(\d{4})-(\d)\.zip$")
+
+# Formats that the trip start and end times show up in when they aren't
+# 'M/D/YYYY H:MM', in the order they should be tried.
+FALLBACK_DATETIME_FORMATS = (
+    # Sometimes the year is only two digits 🙄
+    "%m/%d/%y %H:%M",
     # Sometimes it's already ISO 8601 🙄
-    if ISO8601_PATTERN.match(date_str):
-        return date_str
-    try:
-        return datetime.datetime.strptime(date_str, "%m/%d/%Y %H:%M").isoformat()
-    except ValueError:
-        # Sometimes the year is only two digits 🙄
-        try:
-            return datetime.datetime.strptime(date_str, "%m/%d/%y %H:%M").isoformat()
-        except ValueError:
-            raise ValueError(f"Invalid date format: {date_str}. Expected format: 'M/D/YYYY H:MM' or 'M/D/YY H:MM'.")
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S",
+)
+# ISO 8601 values are trimmed to this many characters ('YYYY-MM-DDTHH:MM:SS')
+# before parsing, to drop any fractional seconds or time zone marker.
+ISO8601_LENGTH = 19
+NUMBER_PATTERN = r"^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$"
 
 
-def str_to_int(value: str) -> int | None:
+def mdyhm_to_datetime(col: pa.ChunkedArray) -> pa.ChunkedArray:
     """
-    Convert a string to an integer, returning None if the string is empty or not a number.
+    Convert a column of date strings in 'M/D/YYYY H:MM' format to timestamps.
+    Empty strings become nulls.
     """
-    if not value:
-        return None
+    result = pc.strptime(col, format="%m/%d/%Y %H:%M", unit="s", error_is_null=True)
+
+    # Arrow's "%Y" will happily parse "24" as the year 0024, so treat those
+    # as unparsed and leave them for the two-digit year format.
+    result = pc.if_else(pc.less(pc.year(result), 100), None, result)
+
+    # Most files use the one format throughout, so only try the others if
+    # something didn't parse.
+    unparsed = pc.and_(pc.is_null(result), pc.not_equal(col, ""))
+    if not pc.any(unparsed).as_py():
+        return result
+
+    # Drop fractional seconds and time zone markers from ISO 8601 values,
+    # which strptime can't parse. Slicing is much cheaper than matching a
+    # regex against every value, and leaves the other formats (which are
+    # always shorter) alone.
+    trimmed = pc.utf8_slice_codeunits(col, 0, ISO8601_LENGTH)
+    for fmt in FALLBACK_DATETIME_FORMATS:
+        result = pc.coalesce(
+            result, pc.strptime(trimmed, format=fmt, unit="s", error_is_null=True))
+
+    invalid = pc.and_(pc.is_null(result), pc.not_equal(col, ""))
+    if pc.any(invalid).as_py():
+        bad_value = pc.filter(col, invalid)[0].as_py()
+        raise ValueError(f"Invalid date format: {bad_value}. Expected format: 'M/D/YYYY H:MM' or 'M/D/YY H:MM'.")
+    return result
+
+
+def str_to_int(col: pa.ChunkedArray) -> pa.ChunkedArray:
+    """
+    Convert a column of strings to integers, with empty strings becoming nulls.
+    """
+    # Strip surrounding whitespace first, like int() does.
+    col = pc.utf8_trim_whitespace(col)
+    nullable = pc.if_else(pc.equal(col, ""), None, col)
     try:
-        return int(value)
-    except ValueError:
-        raise ValueError(f"Invalid integer value: {value}. Expected an integer.")
+        return pc.cast(nullable, pa.int64())
+    except pa.ArrowInvalid as e:
+        raise ValueError(f"Invalid integer value: {e}. Expected an integer.")
 
 
-def latlng_to_point(lat: str, lng: str) -> str | None:
+def latlng_to_point(lat: pa.ChunkedArray, lng: pa.ChunkedArray) -> pa.ChunkedArray:
     """
-    Convert latitude and longitude strings to a WKT POINT representation.
+    Convert columns of latitude and longitude strings to WKT POINT
+    representations. Rows where either coordinate isn't a number are null.
     """
-    if not lat or not lng:
-        return None
-
-    # Check if lat/lng are valid numbers
-    try:
-        float(lat)
-        float(lng)
-    except ValueError:
-        return None
-
-    try:
-        return f"POINT({lng} {lat})"
-    except ValueError:
-        raise ValueError(f"Invalid lat/lng values: {lat}, {lng}. Expected valid coordinates.")
+    # Null out anything that isn't a number. The join below emits null
+    # wherever either input is null, so no separate mask is needed.
+    lat = pc.if_else(pc.match_substring_regex(lat, NUMBER_PATTERN), lat, None)
+    lng = pc.if_else(pc.match_substring_regex(lng, NUMBER_PATTERN), lng, None)
+    return pc.binary_join_element_wise("POINT(", lng, " ", lat, ")", "")
 
 
 def fetch_trip_data(url: str, outstream: typing.BinaryIO) -> None:
     """
     Fetch trip data from a URL and write it to an output stream.
     """
-    import requests
-    response = requests.get(
+    with SESSION.get(
         url,
         allow_redirects=True,
-        headers={"User-Agent": "Mozilla/5.0"}
-    )
-    if response.status_code != 200:
-        raise ValueError(f"Failed to fetch data from {url}: {response.status_code}")
-    outstream.write(response.content)
+        headers={"User-Agent": "Mozilla/5.0"},
+        stream=True,
+    ) as response:
+        if response.status_code != 200:
+            raise ValueError(f"Failed to fetch data from {url}: {response.status_code}")
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            outstream.write(chunk)
 
 
 def make_raw_file_name(label: str) -> str:
     """
     Generate a file name for the trip data based on the label.
     """
-    label_pattern = re.compile(r"^(\d{4}) Q(\d) .*$")
-    year, quarter = label_pattern.match(label).groups()
-    assert year and quarter, f"Invalid label format: {label}. Expected format: 'YYYY QX'."
+    match = LABEL_PATTERN.match(label)
+    assert match, f"Invalid label format: {label}. Expected format: 'YYYY QX'."
+    year, quarter = match.groups()
     return f'indego-trips-{year}-{quarter}.zip'
 
 
@@ -119,28 +174,83 @@ def save_raw_data_local(label: str, url: str) -> None:
     print(f"Saved trip data to {destination_path}")
 
 
-def save_raw_data_gcs(label: str, url: str) -> None:
+def list_blob_names(client: storage.Client, bucket_name: str) -> set[str]:
+    """
+    List the names of all trip data blobs in a bucket. Checking names
+    against this set costs one listing request, instead of one request per
+    blob with `blob.exists()`.
+    """
+    return {blob.name for blob in client.bucket(bucket_name).list_blobs(prefix="trips/")}
+
+
+def blob_exists(blob: storage.Blob, existing_blob_names: set[str] | None) -> bool:
+    """
+    Check whether a blob exists, using a listing from `list_blob_names` if
+    one is given.
+    """
+    if existing_blob_names is None:
+        return blob.exists()
+    return blob.name in existing_blob_names
+
+
+def save_raw_data_gcs(
+        label: str,
+        url: str,
+        client: storage.Client | None = None,
+        existing_blob_names: set[str] | None = None) -> None:
     """
     Save trip data from a URL to a Google Cloud Storage bucket.
     """
-    client = storage.Client()
+    client = client or storage.Client()
     bucket = client.bucket("indego-bikeshare-data")
     blob = bucket.blob(f"trips/{make_raw_file_name(label)}")
 
-    if blob.exists():
+    if blob_exists(blob, existing_blob_names):
         print(f"Trip data for {label} already exists in GCS: {blob.public_url}")
         return
 
-    # Download the file from the URL
-    response = requests.get(url)
-    if response.status_code != 200:
-        raise ValueError(f"Failed to fetch data from {url}: {response.status_code}")
+    print(f"Downloading trip data for {label} from {url}...")
+
+    # Upload the file to GCS as it downloads. If the download fails, the
+    # writer cancels the resumable upload on the way out of the `with`, so
+    # no partial blob is ever created.
+    with blob.open('wb', chunk_size=GCS_UPLOAD_CHUNK_SIZE, content_type="application/zip") as outstream:
+        fetch_trip_data(url, outstream)
 
-    # Upload the file to GCS
-    blob.upload_from_string(response.content, content_type="application/zip")
     print(f"Saved trip data to GCS: {blob.public_url}")
 
 
+def make_savers(location: str) -> tuple[
+        typing.Callable[[str, str], None],
+        typing.Callable[[str], None],
+        list[str]]:
+    """
+    Get the functions that save raw and processed trip data to a location,
+    along with the names of the raw files already saved there, as a
+    (save_raw_data, save_processed_data, raw_file_names) tuple. In GCS mode
+    each bucket is listed only once.
+    """
+    if location == "local":
+        raw_file_names = [f.name for f in DATA_DIR.glob("*.zip")]
+        return save_raw_data_local, save_processed_data_local, raw_file_names
+    elif location == "gcs":
+        # Storage clients are thread-safe, so all the downloads can share one.
+        # Processing happens in other processes, which create their own.
+        client = storage.Client()
+        raw_blob_names = list_blob_names(client, "indego-bikeshare-data")
+        save_raw_data = functools.partial(
+            save_raw_data_gcs,
+            client=client,
+            existing_blob_names=raw_blob_names)
+        save_processed_data = functools.partial(
+            save_processed_data_gcs,
+            existing_blob_names=list_blob_names(client, "indego-bikeshare-data-processed"))
+        raw_file_names = [name.split('/')[-1] for name in raw_blob_names if name.endswith(".zip")]
+        return save_raw_data, save_processed_data, raw_file_names
+    else:
+        raise ValueError("Invalid location specified. Use 'local' or 'gcs'.")
+
+
 def fetch_all_raw_data(location: str) -> None:
     """
     Download trip data from the Indego bikeshare data portal and save it
@@ -148,25 +258,50 @@ def fetch_all_raw_data(location: str) -> None:
     """
     trip_data_urls = get_trip_data_urls()
 
-    if location == "local":
-        save_raw_data = save_raw_data_local
-    elif location == "gcs":
-        save_raw_data = save_raw_data_gcs
-    else:
-        raise ValueError("Invalid location specified. Use 'local' or 'gcs'.")
+    save_raw_data, _, _ = make_savers(location)
 
-    # with ThreadPoolExecutor(max_workers=1) as executor:
-    #     for label, url in trip_data_urls:
-    #         executor.submit(save_raw_data, label, url)
-    for label, url in trip_data_urls:
-        save_raw_data(label, url)
+    # The downloads spend almost all their time waiting on the network, so
+    # run several of them at once.
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [
+            executor.submit(save_raw_data, label, url)
+            for label, url in trip_data_urls
+        ]
+        # Wait on each download so that any exception gets raised here.
+        for future in as_completed(futures):
+            future.result()
+
+
+def convert_trip_data(table: pa.Table) -> pa.Table:
+    """
+    Convert a table of trip data read from CSV (with all string columns) to
+    the types we want to store.
+    """
+    # Convert "duration" to an integer
+    table = table.set_column(
+        table.schema.get_field_index("duration"), "duration",
+        str_to_int(table["duration"]))
+
+    # Convert "start_time" and "end_time" to timestamps
+    for name in ("start_time", "end_time"):
+        table = table.set_column(
+            table.schema.get_field_index(name), name,
+            mdyhm_to_datetime(table[name]))
+
+    # Create a "start_pt" and "end_pt" from lat/lng coordinates
+    table = table.append_column(
+        "start_pt", latlng_to_point(table["start_lat"], table["start_lon"]))
+    table = table.append_column(
+        "end_pt", latlng_to_point(table["end_lat"], table["end_lon"]))
+
+    return table
 
 
 def process_trip_data(
         zipstream: typing.BinaryIO,
-        jsonlstream: typing.TextIO) -> None:
+        parquetstream: typing.BinaryIO) -> None:
     """
-    Process the trip data CSV file and convert it to JSON format.
+    Process the trip data CSV file and convert it to Parquet format.
     """
     # Read the CSV file from the zip archive
     with zipfile.ZipFile(zipstream) as z:
@@ -178,131 +313,251 @@ def process_trip_data(
         # Sometimes the trips file has "echo" in the file name instead of
         # "trips" 🙄.
 
-        trips_filename = next(
-            (name for name in z.namelist()
-             if "trips" in name.lower() or "echo" in name.lower()),
+        trips_info = next(
+            (info for info in z.infolist()
+             if not info.is_dir()
+             and ("trips" in info.filename.lower() or "echo" in info.filename.lower())),
             None
         )
 
-        if not trips_filename:
+        if not trips_info:
             raise ValueError("No trips file found in the zip archive.")
 
-        with z.open(trips_filename) as bytefile:
-            # Wrap the byte file in a text stream
-            csvfile = io.TextIOWrapper(bytefile, encoding='utf-8')
+        with z.open(trips_info) as zipfile_member:
+            # Read ahead in large chunks, which cuts down on the number of
+            # small reads against the (compressed) archive.
+            bytefile = io.BufferedReader(zipfile_member, buffer_size=CSV_READ_BUFFER_SIZE)
+
+            # Peek at the header first, so that every column can be read as
+            # a string. Otherwise Arrow would guess at the types, and e.g.
+            # strip leading zeros from IDs.
+            lines = bytefile.peek(CSV_READ_BUFFER_SIZE).splitlines()
+            if not lines:
+                raise ValueError(f"Trips file {trips_info.filename} is empty.")
+            header = next(csv.reader([lines[0].decode('utf-8-sig')]))
+
+            # Read the CSV file in blocks, and convert and write each block
+            # to the Parquet file (as a row group) before reading the next,
+            # so that the whole file is never in memory at once.
+            reader = pacsv.open_csv(
+                bytefile,
+                read_options=pacsv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+                convert_options=pacsv.ConvertOptions(
+                    column_types={name: pa.string() for name in header},
+                ),
+            )
+            schema = convert_trip_data(reader.schema.empty_table()).schema
+
+            with pq.ParquetWriter(
+                    parquetstream, schema,
+                    compression="zstd", use_dictionary=True) as writer:
+                for batch in reader:
+                    writer.write_table(
+                        convert_trip_data(pa.Table.from_batches([batch])))
+
+
+def parse_raw_file_name(raw_file_name: str) -> tuple[str, str]:
+    """
+    Get the year and quarter from a raw trip data file name.
+    """
+    match = RAW_FILE_NAME_PATTERN.match(raw_file_name)
+    assert match, f"Invalid file name format: {raw_file_name}. Expected format: 'indego-trips-YYYY-Q.zip'."
+    year, quarter = match.groups()
+    return year, quarter
 
-            # Create a CSV reader
-            reader = csv.DictReader(csvfile)
 
-            # Read the CSV file
-            reader = csv.DictReader(csvfile)
-            data = [{
-                **row,
-                # Convert "duration" to an integer
-                "duration": str_to_int(row["duration"]),
-                # Convert "start_time" and "end_time" to ISO format
-                "start_time": mdyhm_to_iso(row["start_time"]),
-                "end_time": mdyhm_to_iso(row["end_time"]),
-                # Create a "start_pt" and "end_pt" from lat/lng coordinates
-                "start_pt": latlng_to_point(row["start_lat"], row["start_lon"]),
-                "end_pt": latlng_to_point(row["end_lat"], row["end_lon"]),
-            } for row in reader]
+def make_processed_file_path(raw_file_name: str) -> pathlib.Path:
+    """
+    Generate the local path for the processed data from a raw file name.
+    """
+    year, quarter = parse_raw_file_name(raw_file_name)
+    return DATA_DIR / f'year={year}/quarter={quarter}/data.parquet'
 
-            # Write the data to a JSON-L file
-            for row in data:
-                json.dump(row, jsonlstream)
-                jsonlstream.write('\n')
 
+def write_processed_data_local(
+        zipstream: typing.BinaryIO,
+        parquet_file_path: pathlib.Path) -> None:
+    """
+    Process a trip data zip file and save it to a local Parquet file.
+    """
+    with parquet_file_path.open('wb', buffering=LOCAL_WRITE_BUFFER_SIZE) as parquetstream:
+        try:
+            process_trip_data(zipstream, parquetstream)
+        except Exception as e:
+            # Delete the parquet file if processing fails
+            if parquet_file_path.exists():
+                parquet_file_path.unlink()
+            raise e
+
+    print(f"Processed trip data saved to {parquet_file_path}")
 
-def save_processed_data_local(raw_file_name: str) -> None:
+
+def save_processed_data_local(raw_file_name: str, zipbytes: bytes | None = None) -> None:
     """
-    Process the trip data CSV file and save it to a JSONL file.
+    Process the trip data CSV file and save it to a Parquet file. If the zip
+    file's contents are given, process those instead of reading the file.
     """
     DATA_DIR.mkdir(parents=True, exist_ok=True)
 
     raw_file_path = DATA_DIR / raw_file_name
-    fn_pattern = re.compile(r"^indego-trips-(\d{4})-(\d).zip$")
-    year, quarter = fn_pattern.match(raw_file_name).groups()
-    assert year and quarter, f"Invalid file name format: {raw_file_name}. Expected format: 'indego-trips-YYYY-Q.zip'."
-    jsonl_file_path = DATA_DIR / f'year={year}/quarter={quarter}/data.jsonl'
-    jsonl_file_path.parent.mkdir(parents=True, exist_ok=True)
-
-    if jsonl_file_path.exists():
-        print(f"Processed data already exists at {jsonl_file_path}")
+    parquet_file_path = make_processed_file_path(raw_file_name)
+    parquet_file_path.parent.mkdir(parents=True, exist_ok=True)
+
+    if parquet_file_path.exists():
+        print(f"Processed data already exists at {parquet_file_path}")
+        return
+
+    if zipbytes is not None:
+        print(f"Processing trip data for {raw_file_name} from memory...")
+        write_processed_data_local(io.BytesIO(zipbytes), parquet_file_path)
         return
 
     print(f"Processing trip data from {raw_file_path}...")
 
     with raw_file_path.open('rb') as zipstream:
-        with jsonl_file_path.open('w') as jsonlstream:
-            try:
-                process_trip_data(zipstream, jsonlstream)
-            except Exception as e:
-                # Delete the jsonl file if processing fails
-                if jsonl_file_path.exists():
-                    jsonl_file_path.unlink()
-                raise e
+        write_processed_data_local(zipstream, parquet_file_path)
 
-    print(f"Processed trip data saved to {jsonl_file_path}")
 
+def fetch_raw_data_local(label: str, url: str) -> bytes | None:
+    """
+    Download trip data from a URL into memory, without saving the zip file.
+    Returns None if the data has already been processed, or if an earlier
+    run already saved the zip file.
+    """
+    raw_file_name = make_raw_file_name(label)
+    if make_processed_file_path(raw_file_name).exists() or (DATA_DIR / raw_file_name).exists():
+        return None
+
+    print(f"Downloading trip data for {label} from {url}...")
+
+    # Zip files keep their table of contents at the end, so the download
+    # has to finish before it can be read.
+    zipstream = io.BytesIO()
+    fetch_trip_data(url, zipstream)
+    return zipstream.getvalue()
 
-def save_processed_data_gcs(raw_file_name: str) -> None:
+
+def save_processed_data_gcs(
+        raw_file_name: str,
+        existing_blob_names: set[str] | None = None) -> None:
     """
-    Process the trip data CSV file and save it to a JSONL file in GCS.
+    Process the trip data CSV file and save it to a Parquet file in GCS.
     """
     client = storage.Client()
     raw_bucket = client.bucket("indego-bikeshare-data")
     processed_bucket = client.bucket("indego-bikeshare-data-processed")
 
     raw_blob = raw_bucket.blob(f"trips/{raw_file_name}")
-    year, quarter = raw_file_name.split('-')[2:4]
-    jsonl_blob = processed_bucket.blob(f"trips/year={year}/quarter={quarter}/data.jsonl")
+    year, quarter = parse_raw_file_name(raw_file_name)
+    parquet_blob = processed_bucket.blob(f"trips/year={year}/quarter={quarter}/data.parquet")
 
-    if jsonl_blob.exists():
-        print(f"Processed data already exists in GCS: {jsonl_blob.public_url}")
+    if blob_exists(parquet_blob, existing_blob_names):
+        print(f"Processed data already exists in GCS: {parquet_blob.public_url}")
         return
 
+    # As in save_raw_data_gcs, if processing fails the writer cancels the
+    # upload on the way out of the `with`, so no partial blob is created.
     with raw_blob.open('rb') as zipstream:
-        with jsonl_blob.open('w') as jsonlstream:
-            try:
-                process_trip_data(zipstream, jsonlstream)
-            except Exception as e:
-                # Delete the jsonl blob if processing fails
-                if jsonl_blob.exists():
-                    jsonl_blob.delete()
-                raise e
+        with parquet_blob.open('wb', chunk_size=GCS_UPLOAD_CHUNK_SIZE) as parquetstream:
+            process_trip_data(zipstream, parquetstream)
 
-    print(f"Processed trip data saved to GCS: {jsonl_blob.public_url}")
+    print(f"Processed trip data saved to GCS: {parquet_blob.public_url}")
 
 
 def process_all_trip_data(location: str) -> None:
     """
-    Process all trip data files and convert them to JSON format.
+    Process all trip data files and convert them to Parquet format.
     """
-    if location == "local":
-        save_processed_data = save_processed_data_local
-        raw_file_names = [f.name for f in DATA_DIR.glob("*.zip")]
-    elif location == "gcs":
-        save_processed_data = save_processed_data_gcs
-        client = storage.Client()
-        raw_bucket = client.bucket("indego-bikeshare-data")
-        raw_blobs = raw_bucket.list_blobs(prefix="trips/")
-        raw_file_names = [blob.name.split('/')[-1] for blob in raw_blobs if blob.name.endswith(".zip")]
-    else:
-        raise ValueError("Invalid location specified. Use 'local' or 'gcs'.")
+    _, save_processed_data, raw_file_names = make_savers(location)
+
+    # Processing is CPU-bound, so spread the files over one process per
+    # core. In GCS mode each call creates its own storage client, as clients
+    # can't be shared across processes.
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(save_processed_data, raw_file_names))
 
-    for raw_file_name in raw_file_names:
-        save_processed_data(raw_file_name)
-    # with ProcessPoolExecutor(max_workers=8) as executor:
-    #     for raw_file_name in raw_file_names:
-    #         executor.submit(save_processed_data, raw_file_name)
 
+def fetch_and_process_all_data(location: str) -> None:
+    """
+    Download and process all trip data, processing each file as soon as its
+    download finishes instead of waiting for all the downloads first.
+    """
+    trip_data_urls = get_trip_data_urls()
+
+    save_raw_data, save_processed_data, _ = make_savers(location)
+    if location == "local":
+        # Locally there's no need to keep the zip files, so downloads are
+        # kept in memory and handed straight to the processing workers.
+        save_raw_data = fetch_raw_data_local
+
+    # Downloads that finish faster than they can be processed pile up in
+    # memory, so only let a few more files than there are workers be
+    # downloaded but not yet processed at any time.
+    pending_files = threading.BoundedSemaphore(2 * os.cpu_count())
+
+    # Set when something fails, so that downloads still waiting for a slot
+    # give up instead of waiting for processing that will never happen.
+    stop = threading.Event()
+
+    def download(label: str, url: str) -> bytes | None:
+        while not pending_files.acquire(timeout=1):
+            if stop.is_set():
+                return None
+        if stop.is_set():
+            pending_files.release()
+            return None
+        try:
+            return save_raw_data(label, url)
+        except Exception:
+            pending_files.release()
+            raise
+
+    # Downloads run in threads and processing runs in processes, like in
+    # fetch_all_raw_data and process_all_trip_data, so that the CPU stays
+    # busy while files are still downloading. The worker processes only
+    # start once downloads are underway, so they come from a forkserver:
+    # forking a process that has running threads can leave the children
+    # holding locks (e.g. in ssl or urllib3) that will never be released.
+    with ThreadPoolExecutor(max_workers=8) as download_executor, \
+            ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context("forkserver")) as process_executor:
+        download_futures = {
+            download_executor.submit(download, label, url): label
+            for label, url in trip_data_urls
+        }
+        try:
+            process_futures = []
+            for future in as_completed(download_futures):
+                zipbytes = future.result()
+                raw_file_name = make_raw_file_name(download_futures[future])
+
+                # Only local downloads are kept in memory; everything else is
+                # read back from where save_raw_data put it.
+                args = (raw_file_name,) if zipbytes is None else (raw_file_name, zipbytes)
+                try:
+                    process_future = process_executor.submit(save_processed_data, *args)
+                except Exception:
+                    pending_files.release()
+                    raise
+                process_future.add_done_callback(lambda _: pending_files.release())
+                process_futures.append(process_future)
+
+            # Wait on each processing job so that any exception gets raised here.
+            for future in as_completed(process_futures):
+                future.result()
+        except BaseException:
+            # Drop the downloads that haven't started, and let the running
+            # ones give up, so that leaving the `with` doesn't wait on them
+            # forever.
+            stop.set()
+            download_executor.shutdown(wait=False, cancel_futures=True)
+            raise
 
 if __name__ == "__main__":
-    # Use stdin as the input CSV file and stdout as the output JSONL file
+    # Use stdin as the input CSV file and stdout as the output Parquet file
     # process_trip_data(
     #     zipstream=sys.stdin,
-    #     jsonlstream=sys.stdout
+    #     parquetstream=sys.stdout
     # )
-    fetch_all_raw_data("local")
-    process_all_trip_data("local")
+    fetch_and_process_all_data("local")
@@ -1,4 +1,10 @@
-CREATE OR REPLACE TABLE core.indego_trips AS (
+-- Partitioned by month rather than by day, because daily partitions since
+-- 2015 would run past BigQuery's limit of 4,000 partitions per table.
+
+CREATE OR REPLACE TABLE core.indego_trips
+PARTITION BY DATE_TRUNC(start_date, MONTH)
+CLUSTER BY start_hour, start_station
+AS (
     SELECT
         *,
         S2_CELLIDFROMPOINT(start_pt, 12) AS start_s2r12,
@@ -13,5 +19,7 @@ CREATE OR REPLACE TABLE core.indego_trips AS (
         S2_CELLIDFROMPOINT(end_pt, 16) AS end_s2r16,
         EXTRACT(DATE FROM start_time) AS start_date,
         EXTRACT(DATE FROM end_time) AS end_date,
+        EXTRACT(HOUR FROM start_time) AS start_hour,
+        EXTRACT(HOUR FROM end_time) AS end_hour,
     FROM source.indego_trips
 )
\ No newline at end of file
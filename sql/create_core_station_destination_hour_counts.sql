@@ -0,0 +1,16 @@
+-- Per-station, per-hour, per-day counts of trips ending at each station.
+-- The popularity API sums over this rollup instead of scanning the full
+-- core.indego_trips table on every request.
+
+CREATE OR REPLACE MATERIALIZED VIEW core.station_destination_hour_counts
+CLUSTER BY hour, trip_date, station_id
+AS (
+    SELECT
+        end_station AS station_id,
+        end_hour AS hour,
+        end_date AS trip_date,
+        ANY_VALUE(end_pt) AS station_pt,
+        COUNT(*) AS trip_count
+    FROM core.indego_trips
+    GROUP BY station_id, hour, trip_date
+)
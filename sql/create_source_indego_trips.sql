@@ -1,6 +1,6 @@
 -- Create or replace the source.indego_trips external table
 -- to load the Indego bike share trip data from GCS at
--- gs://indego-bikeshare-tools-prepared_data/indego_trips/year=2024/*.jsonl
+-- gs://indego-bikeshare-tools-prepared_data/indego_trips/year=2024/*.parquet
 -- Use the year as a partition key.
 
 CREATE OR REPLACE EXTERNAL TABLE source.indego_trips (
@@ -23,8 +23,8 @@ WITH PARTITION COLUMNS (
     quarter INT,
 )
 OPTIONS (
-    format = 'JSON',
-    uris = ['gs://indego-bikeshare-tools-prepared_data/indego_trips/*.jsonl'],
+    format = 'PARQUET',
+    uris = ['gs://indego-bikeshare-tools-prepared_data/indego_trips/*.parquet'],
     hive_partition_uri_prefix = 'gs://indego-bikeshare-tools-prepared_data/indego_trips/',
     ignore_unknown_values = TRUE
 )